@@ -2,102 +2,154 @@ import argparse
 import textwrap
 import logging
 import os
-import gzip
+import typing
+from dataclasses import dataclass
 
 import pandas as pd
+from pandas.api.types import union_categoricals
 
 import pgscatalog_utils.config as config
-from pgscatalog_utils.ancestry.read import read_pcs, read_pgs, extract_ref_psam_cols
+from pgscatalog_utils.ancestry.read import read_pcs, read_pgs, extract_ref_psam_cols, scan_pcs, scan_pgs, \
+    collect_pcs
 from pgscatalog_utils.ancestry.tools import compare_ancestry, comparison_method_threshold, choose_pval_threshold, \
     pgs_adjust, normalization_methods, write_model
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass(frozen=True, slots=True)
+class AncestryConfig:
+    """ Settings for ancestry_analysis, resolved once from the parsed command line arguments """
+    d_target: str
+    d_ref: str
+    ref_pcs: tuple[str, ...]
+    target_pcs: tuple[str, ...]
+    psam: str
+    ref_related: typing.Union[None, str]
+    ref_label: str
+    scorefile: str
+    method_compare: str
+    p_threshold: float
+    nPCs_popcomp: int
+    method_normalization: tuple[str, ...]
+    nPCs_normalization: int
+    maxPCs: int
+    engine: str
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace):
+        return cls(d_target=args.d_target, d_ref=args.d_ref,
+                   ref_pcs=tuple(args.ref_pcs), target_pcs=tuple(args.target_pcs),
+                   psam=args.psam, ref_related=args.ref_related, ref_label=args.ref_label,
+                   scorefile=args.scorefile,
+                   method_compare=args.method_compare,
+                   p_threshold=choose_pval_threshold(args.method_compare, args.pThreshold),
+                   nPCs_popcomp=args.nPCs_popcomp,
+                   method_normalization=tuple(args.method_normalization),
+                   nPCs_normalization=args.nPCs_normalization,
+                   maxPCs=max([10, args.nPCs_popcomp, args.nPCs_normalization]),  # save memory by not using all PCs
+                   engine=args.engine)
+
+
 def ancestry_analysis():
     args = _parse_args()
     config.set_logging_level(args.verbose)
     config.OUTDIR = args.outdir
-
-    # Load PCA data
-    maxPCs = max([10, args.nPCs_popcomp, args.nPCs_normalization])  # save memory by not using all PCs
-    loc_ref_pcs = args.ref_pcs
-    reference_df = read_pcs(loc_pcs=loc_ref_pcs, dataset=args.d_ref,
-                            loc_related_ids=args.ref_related, nPCs=maxPCs)
-    loc_ref_psam = args.psam
-    reference_df = extract_ref_psam_cols(loc_ref_psam, args.d_ref, reference_df, keepcols=[args.ref_label])
-
-    loc_target_sscores = args.target_pcs
-    target_df = read_pcs(loc_pcs=loc_target_sscores, dataset=args.d_target, nPCs=maxPCs)
-
-    # Load PGS data & merge with PCA data
-    pgs = read_pgs(args.scorefile, onlySUM=True)
-    scorecols = list(pgs.columns)
-    reference_df = pd.merge(reference_df, pgs, left_index=True, right_index=True)
-    target_df = pd.merge(target_df, pgs, left_index=True, right_index=True)
-    del pgs  # clear raw PGS from memory
+    config.setup_polars_threads(args.n_threads)
+    cfg = AncestryConfig.from_args(args)
+
+    if cfg.engine == 'polars':
+        # Load PCA & PGS data lazily, only collect the joined data before handing over to pandas/sklearn
+        pgs = scan_pgs(cfg.scorefile, onlySUM=True)
+        scorecols = [x for x in pgs.columns if x not in ['sampleset', 'IID']]
+        reference_df = collect_pcs(scan_pcs(loc_pcs=cfg.ref_pcs, dataset=cfg.d_ref, nPCs=cfg.maxPCs)
+                                   .join(pgs, on=['sampleset', 'IID'], how='inner'),
+                                   loc_related_ids=cfg.ref_related)
+        reference_df = extract_ref_psam_cols(cfg.psam, cfg.d_ref, reference_df, keepcols=[cfg.ref_label])
+        target_df = collect_pcs(scan_pcs(loc_pcs=cfg.target_pcs, dataset=cfg.d_target, nPCs=cfg.maxPCs)
+                                .join(pgs, on=['sampleset', 'IID'], how='inner'))
+        del pgs
+    else:
+        # Load PCA data
+        loc_ref_pcs = cfg.ref_pcs
+        reference_df = read_pcs(loc_pcs=loc_ref_pcs, dataset=cfg.d_ref,
+                                loc_related_ids=cfg.ref_related, nPCs=cfg.maxPCs)
+        loc_ref_psam = cfg.psam
+        reference_df = extract_ref_psam_cols(loc_ref_psam, cfg.d_ref, reference_df, keepcols=[cfg.ref_label])
+
+        loc_target_sscores = cfg.target_pcs
+        target_df = read_pcs(loc_pcs=loc_target_sscores, dataset=cfg.d_target, nPCs=cfg.maxPCs)
+
+        # Load PGS data & merge with PCA data
+        pgs = read_pgs(cfg.scorefile, onlySUM=True)
+        scorecols = list(pgs.columns)
+        reference_df = reference_df.join(pgs, how='inner')
+        target_df = target_df.join(pgs, how='inner')
+        del pgs  # clear raw PGS from memory
 
     # Compare target sample ancestry/PCs to reference panel
-    assignment_threshold_p = choose_pval_threshold(args)
     ancestry_ref, ancestry_target, compare_info = compare_ancestry(ref_df=reference_df,
-                                                                   ref_pop_col=args.ref_label, ref_train_col='Unrelated',
+                                                                   ref_pop_col=cfg.ref_label, ref_train_col='Unrelated',
                                                                    target_df=target_df,
-                                                                   n_pcs=args.nPCs_popcomp,
-                                                                   method=args.method_compare,
-                                                                   p_threshold=assignment_threshold_p)
+                                                                   n_pcs=cfg.nPCs_popcomp,
+                                                                   method=cfg.method_compare,
+                                                                   p_threshold=cfg.p_threshold)
 
-    reference_df = pd.concat([reference_df, ancestry_ref], axis=1)
-    target_df = pd.concat([target_df, ancestry_target], axis=1)
+    reference_df = reference_df.join(ancestry_ref)  # same index, columns are appended without a full concat
+    target_df = target_df.join(ancestry_target)
     del ancestry_ref, ancestry_target
 
     # Adjust PGS values
     adjpgs_ref, adjpgs_target, adjpgs_models = pgs_adjust(reference_df, target_df, scorecols,
-                                                          args.ref_label, 'MostSimilarPop',
-                                                          use_method=args.method_normalization,
+                                                          cfg.ref_label, 'MostSimilarPop',
+                                                          use_method=cfg.method_normalization,
                                                           ref_train_col='Unrelated',
-                                                          n_pcs=args.nPCs_normalization)
-    adjpgs = pd.concat([adjpgs_ref, adjpgs_target], axis=0)
+                                                          n_pcs=cfg.nPCs_normalization)
+    adjpgs = pd.concat(_unify_sampleset([adjpgs_ref, adjpgs_target]), axis=0)
     del adjpgs_ref, adjpgs_target
 
     # Write outputs
     dout = os.path.abspath(config.OUTDIR)
     if os.path.isdir(dout) is False:
         os.mkdir(dout)
+    # raw PGS are in adjpgs (SUM), so drop them before combining the ancestry results
+    reference_df.drop(columns=scorecols, inplace=True)
+    target_df.drop(columns=scorecols, inplace=True)
     reference_df['REFERENCE'] = True
     target_df['REFERENCE'] = False
-    final_df = pd.concat([target_df, reference_df], axis=0)
+    final_df = pd.concat(_unify_sampleset([target_df, reference_df]), axis=0)
     del reference_df, target_df
 
     # Write Models
-    write_model({'pgs': adjpgs_models, 'compare_pcs': compare_info}, os.path.join(dout, f"{args.d_target}_info.json.gz"))
+    write_model({'pgs': adjpgs_models, 'compare_pcs': compare_info}, os.path.join(dout, f"{cfg.d_target}_info.json.gz"))
 
-    # Melt & write PGS
+    # Reshape & write PGS
     # Currently each PGS will have it's own row... but it might be more optimal for each normalization method
     #  to be on separate rows? My logic is that you might want to check correaltion between methods and it is easiest
     #  in this format.
-    loc_pgs_out = os.path.join(dout, f"{args.d_target}_pgs.txt.gz")
-    with gzip.open(loc_pgs_out, 'wt') as outf:
-        logger.debug('Writing adjusted PGS values (long format) to: {}'.format(loc_pgs_out))
-        for i, pgs_id in enumerate(scorecols):
-            df_pgs = adjpgs.loc[:, adjpgs.columns.str.endswith(pgs_id)].melt(ignore_index=False)  # filter to 1 PGS
-            df_pgs[['method', 'PGS']] = df_pgs.variable.str.split("|", expand=True)
-            df_pgs = df_pgs.drop('variable', axis=1).reset_index().pivot(index=['sampleset', 'IID', 'PGS'],
-                                                                         columns='method', values='value')
-            if i == 0:
-                logger.debug('{}/{}: Writing {}'.format(i+1, len(scorecols), pgs_id))
-                colorder = list(df_pgs.columns)  # to ensure sort order
-                df_pgs.to_csv(outf, sep='\t')
-            else:
-                logger.debug('{}/{}: Appending {}'.format(i+1, len(scorecols), pgs_id))
-                df_pgs[colorder].to_csv(outf, sep='\t', header=False)
+    loc_pgs_out = os.path.join(dout, f"{cfg.d_target}_pgs.txt.gz")
+    logger.debug('Writing adjusted PGS values (long format) to: {}'.format(loc_pgs_out))
+    adjpgs.columns = pd.MultiIndex.from_tuples([tuple(x.split('|', 1)) for x in adjpgs.columns],
+                                               names=['method', 'PGS'])
+    adjpgs = adjpgs.stack('PGS', dropna=False).sort_index(axis=1).sort_index()  # one row per sample & PGS
+    adjpgs.to_csv(loc_pgs_out, sep='\t', compression={'method': 'gzip', 'compresslevel': 1})
 
     # Write results of PCA & population similarity
-    loc_popsim_out = os.path.join(dout, f"{args.d_target}_popsimilarity.txt.gz")
+    loc_popsim_out = os.path.join(dout, f"{cfg.d_target}_popsimilarity.txt.gz")
     logger.debug('Writing PCA and popsim results to: {}'.format(loc_popsim_out))
-    final_df.drop(scorecols, axis=1).to_csv(loc_popsim_out, sep='\t')
+    final_df.to_csv(loc_popsim_out, sep='\t', compression={'method': 'gzip', 'compresslevel': 1})
     logger.info("Finished ancestry analysis")
 
 
+def _unify_sampleset(dfs: list[pd.DataFrame]) -> list[pd.DataFrame]:
+    """ Set the same categories on the sampleset index level of each dataframe, so they concat without re-factorizing
+    the index """
+    cats = union_categoricals([pd.Categorical(df.index.levels[0]) for df in dfs]).categories
+    for df in dfs:
+        df.index = df.index.set_levels(pd.CategoricalIndex(df.index.levels[0], categories=cats), level='sampleset')
+    return dfs
+
+
 def _description_text() -> str:
     return textwrap.dedent('Program to analyze ancestry outputs of the pgscatalog/pgsc_calc pipeline. Current inputs: '
                            '\n  - PCA projections from reference and target datasets (*.pcs)'
@@ -139,6 +191,10 @@ def _parse_args(args=None):
     parser.add_argument('--n_normalization', dest='nPCs_normalization', type=int, metavar="[1-20]",
                         choices=range(1, 21), default=4,
                         help='Number of PCs used for population NORMALIZATION (default = 4)')
+    parser.add_argument('--engine', dest='engine', choices=['pandas', 'polars'], default='pandas',
+                        help='<Optional> Library used to read and join the PCA and PGS data (default = pandas)')
+    parser.add_argument('--n_threads', dest='n_threads', default=1, type=int,
+                        help='<Optional> n threads for reading data (polars engine)')
     parser.add_argument('--outdir', dest='outdir', required=True,
                         help='<Required> Output directory')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
@@ -1,8 +1,14 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import pandas as pd
 import numpy as np
+import polars as pl
 import os
 
+import pgscatalog_utils.config as config
+
 logger = logging.getLogger(__name__)
 
 
@@ -12,38 +18,98 @@ def read_pcs(loc_pcs: list[str],dataset: str, loc_related_ids=None, nPCs=None):
     :param loc_pcs: list of locations for .pcs files
     :param dataset: name of the dataset being read (used for index)
     :param loc_related_ids: path to newline-delimited list of IDs for related samples that can be used to filter
+    :param nPCs: maximum number of PCs to read (PCs above this are never loaded)
     :return: pandas dataframe with PC information
     """
-    proj = pd.DataFrame()
+    # parsing is done in C and releases the GIL, so files (e.g. split by chromosome) can be read in parallel
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(loc_pcs)))) as executor:
+        frames = list(executor.map(partial(_read_pcs_file, dataset=dataset, nPCs=nPCs), loc_pcs))
 
-    for i, path in enumerate(loc_pcs):
-        logger.debug("Reading PCA projection: {}".format(path))
-        df = pd.read_csv(path, sep='\t')
-        df['sampleset'] = dataset
-        df.set_index(['sampleset', 'IID'], inplace=True)
+    logger.debug('Combining {} PCA projection(s)'.format(len(frames)))
+    proj = pd.concat(frames, copy=False) if frames else pd.DataFrame()
+
+    return flag_related(proj, loc_related_ids)
+
+
+def _read_pcs_file(path: str, dataset: str, nPCs=None) -> pd.DataFrame:
+    """ Read a single .pcs file into a [sampleset, IID] indexed dataframe """
+    logger.debug("Reading PCA projection: {}".format(path))
+    header = pd.read_csv(path, sep='\t', nrows=0).columns
+    pcs = _pc_columns(header, nPCs)
+    keep = ['IID'] + pcs
+    dtype = {x: np.float32 for x in pcs}
+    dtype['IID'] = str  # must match the IID dtype of the psam & aggregated scores for joins
+    df = pd.read_csv(path, sep='\t', usecols=keep, dtype=dtype)
+    iids = df.pop('IID').to_numpy()
+    df.index = pd.MultiIndex.from_arrays([np.broadcast_to(dataset, len(iids)), iids], names=['sampleset', 'IID'])
+    return df
 
-        if i == 0:
-            logger.debug('Initialising combined DF')
-            proj = df.copy()
-        else:
-            logger.debug('Appending to combined DF')
-            proj = pd.concat([proj, df])
 
-    # Drop PCs
+def _pc_columns(header, nPCs=None) -> list[str]:
+    """ PC columns (PC1, PC2, ...) present in a .pcs header, optionally limited to the first nPCs """
     if nPCs:
-        logger.debug('Filtering to relevant PCs')
-        dropcols = []
-        for x in proj.columns:
-            if int(x[2:]) > nPCs:
-                dropcols.append(x)
-        proj = proj.drop(dropcols, axis=1)
+        keep = {'PC{}'.format(x + 1) for x in range(nPCs)}
+        return [x for x in header if x in keep]
+    return [x for x in header if x.startswith('PC') and x[2:].isdigit()]
+
+
+def scan_pcs(loc_pcs: list[str], dataset: str, nPCs=None) -> pl.LazyFrame:
+    """
+    Lazily scan the .pc file outputs of the fraposa_pgsc projection (polars engine)
+    :param loc_pcs: list of locations for .pcs files
+    :param dataset: name of the dataset being read (used for sampleset column)
+    :param nPCs: maximum number of PCs to read (PCs above this are never loaded)
+    :return: polars LazyFrame with row_nr (input order), sampleset, IID and PC columns
+    """
+    frames = []
+
+    for path in loc_pcs:
+        logger.debug("Scanning PCA projection: {}".format(path))
+        if _is_gzip(path):
+            # polars can't scan compressed files, so read eagerly and continue lazily
+            lf = pl.read_csv(path, sep='\t', dtypes={'IID': pl.Utf8}, n_threads=config.N_THREADS).lazy()
+        else:
+            lf = pl.scan_csv(path, sep='\t', dtypes={'IID': pl.Utf8})
+        pcs = _pc_columns(lf.columns, nPCs)
+        frames.append(lf.select([pl.lit(dataset).alias('sampleset'), pl.col('IID'),
+                                 *[pl.col(x).cast(pl.Float32) for x in pcs]]))
+
+    # joins don't keep the order of the left frame, but the ancestry methods are sensitive to sample order
+    return pl.concat(frames).with_row_count()
+
+
+def _is_gzip(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def collect_pcs(lf: pl.LazyFrame, loc_related_ids=None) -> pd.DataFrame:
+    """
+    Execute a lazy PCA query and hand it over to pandas (used by the sklearn-based methods)
+    :param lf: polars LazyFrame with row_nr, sampleset & IID columns (see scan_pcs)
+    :param loc_related_ids: path to newline-delimited list of IDs for related samples that can be used to filter
+    :return: [sampleset, IID] indexed pandas dataframe, in the row order of the .pcs files
+    """
+    df = lf.sort('row_nr').drop('row_nr').collect()
+    # build the frame column by column, polars' to_pandas() requires pyarrow
+    index = pd.MultiIndex.from_arrays([df['sampleset'].to_list(), df['IID'].to_list()], names=['sampleset', 'IID'])
+    proj = pd.DataFrame({x: df[x].to_numpy() for x in df.columns if x not in ['sampleset', 'IID']}, index=index)
+    return flag_related(proj, loc_related_ids)
+
 
+def flag_related(proj: pd.DataFrame, loc_related_ids=None) -> pd.DataFrame:
+    """
+    Add a column (Unrelated) flagging samples that can be used for training ancestry/normalization methods
+    :param proj: [sampleset, IID] indexed dataframe
+    :param loc_related_ids: path to newline-delimited list of IDs for related samples that can be used to filter
+    :return: proj with Unrelated column (NaN if loc_related_ids is missing)
+    """
     # Read/process IDs for unrelated samples (usually reference dataset)
     if loc_related_ids:
         logger.debug("Flagging related samples with: {}".format(loc_related_ids))
         proj['Unrelated'] = True
         with open(loc_related_ids, 'r') as infile:
-            IDs_related = [x.strip() for x in infile.readlines()]
+            IDs_related = set(x.strip() for x in infile)
         proj.loc[proj.index.get_level_values(level=1).isin(IDs_related), 'Unrelated'] = False
     else:
         proj['Unrelated'] = np.nan
@@ -51,34 +117,74 @@ def read_pcs(loc_pcs: list[str],dataset: str, loc_related_ids=None, nPCs=None):
     return proj
 
 
+# psam IID column, keyed by the first column of the header (#IID -> IID happens when #FID is present)
+_psam_iid_cols = {'#IID': '#IID', '#FID': 'IID'}
+
+
 def extract_ref_psam_cols(loc_psam, dataset: str, df_target, keepcols=['SuperPop', 'Population']):
-    psam = pd.read_csv(loc_psam, sep='\t')
-
-    match (psam.columns[0]):
-        # handle case of #IID -> IID (happens when #FID is present)
-        case '#IID':
-            psam.rename({'#IID': 'IID'}, axis=1, inplace=True)
-        case '#FID':
-            psam.drop(['#FID'], axis=1, inplace=True)
-        case _:
-            assert False, "Invalid columns"
+    """
+    Add population label columns from the reference panel psam file
+    :param loc_psam: path to plink2 psam file for the reference panel
+    :param dataset: name of the reference dataset (used for index)
+    :param df_target: [sampleset, IID] indexed dataframe the labels are joined to
+    :param keepcols: psam columns to keep (only these & the IID column are parsed)
+    :return: df_target with keepcols (inner join)
+    """
+    first_col = pd.read_csv(loc_psam, sep='\t', nrows=0).columns[0]
+    if first_col not in _psam_iid_cols:
+        raise ValueError("Invalid psam columns, expected the first column to be one of {} (found: {})"
+                         .format(list(_psam_iid_cols.keys()), first_col))
+    iid_col = _psam_iid_cols[first_col]
+
+    dtype = {x: 'category' for x in keepcols}
+    dtype[iid_col] = str
+    psam = pd.read_csv(loc_psam, sep='\t', usecols=[iid_col] + keepcols, dtype=dtype)
+    psam.rename({iid_col: 'IID'}, axis=1, inplace=True)
     psam['sampleset'] = dataset
     psam.set_index(['sampleset', 'IID'], inplace=True)
 
-    return pd.merge(df_target, psam[keepcols], left_index=True, right_index=True)
+    return df_target.join(psam, how='inner')
 
 
-def read_pgs(loc_aggscore, onlySUM: bool):
+def read_pgs(loc_aggscore, onlySUM: bool, chunksize=200_000):
     """
     Function to read the output of aggreagte_scores
     :param loc_aggscore: path to aggregated scores output
     :param onlySUM: whether to return only _SUM columns (e.g. not _AVG)
-    :return:
+    :param chunksize: number of rows parsed at a time (bounds parser memory for very large files)
+    :return: [sampleset, IID] indexed (sorted) pandas dataframe
     """
     logger.debug('Reading aggregated score data: {}'.format(loc_aggscore))
-    df = pd.read_csv(loc_aggscore, sep='\t', index_col=['sampleset', 'IID'])
     if onlySUM:
-        df = df[[x for x in df.columns if x.endswith('_SUM')]]
-        rn = [x.rstrip('_SUM') for x in df.columns]
-        df.columns = rn
-    return df
\ No newline at end of file
+        usecols = lambda x: x in ['sampleset', 'IID'] or x.endswith('_SUM')  # skip parsing _AVG columns
+    else:
+        usecols = None
+    # dtypes are guessed per chunk, so IDs must be read explicitly as text to be consistent across chunks
+    with pd.read_csv(loc_aggscore, sep='\t', usecols=usecols, chunksize=chunksize,
+                     dtype={'sampleset': str, 'IID': str}) as reader:
+        df = pd.concat([x.set_index(['sampleset', 'IID']) for x in reader], copy=False).sort_index()
+    if onlySUM:
+        df.columns = df.columns.str.removesuffix('_SUM')
+    return df
+
+
+def scan_pgs(loc_aggscore, onlySUM: bool) -> pl.LazyFrame:
+    """
+    Function to read the output of aggregate_scores into a polars LazyFrame (polars engine)
+    :param loc_aggscore: path to aggregated scores output
+    :param onlySUM: whether to return only _SUM columns (e.g. not _AVG)
+    :return: polars LazyFrame with sampleset, IID and score columns
+    """
+    logger.debug('Reading aggregated score data: {}'.format(loc_aggscore))
+    header = pl.read_csv(loc_aggscore, sep='\t', n_rows=0, dtypes={'sampleset': pl.Utf8, 'IID': pl.Utf8}).columns
+    if onlySUM:
+        cols = ['sampleset', 'IID'] + [x for x in header if x.endswith('_SUM')]
+    else:
+        cols = header
+
+    # polars can't scan compressed files, so read the scores eagerly and continue lazily
+    df = pl.read_csv(loc_aggscore, sep='\t', columns=cols, dtypes={'sampleset': pl.Utf8, 'IID': pl.Utf8},
+                     n_threads=config.N_THREADS)
+    if onlySUM:
+        df = df.rename({x: x.removesuffix('_SUM') for x in cols[2:]})
+    return df.lazy()
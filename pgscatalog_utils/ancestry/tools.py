@@ -25,13 +25,13 @@ comparison_method_threshold = {"Mahalanobis": 1e-10,
 _mahalanobis_methods = ["MinCovDet", "EmpiricalCovariance"]
 
 
-def choose_pval_threshold(args):
-    set_threshold = comparison_method_threshold[args.method_compare]  # method default
-    if args.pThreshold is not None:
-        if (args.pThreshold > 0) and (args.pThreshold < 1):
-            set_threshold = args.pThreshold
+def choose_pval_threshold(method_compare: str, pThreshold=None):
+    set_threshold = comparison_method_threshold[method_compare]  # method default
+    if pThreshold is not None:
+        if (pThreshold > 0) and (pThreshold < 1):
+            set_threshold = pThreshold
         else:
-            logging.warning("p-value threshold out of range, assigning as method default: {}")
+            logging.warning("p-value threshold out of range, assigning as method default: {}".format(set_threshold))
     return set_threshold
 
 
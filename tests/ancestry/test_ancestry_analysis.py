@@ -0,0 +1,68 @@
+""" Test the ancestry_analysis CLI gives the same results with each engine """
+
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgscatalog_utils.ancestry.ancestry_analysis import ancestry_analysis
+
+
+def test_engine_parity(ancestry_args):
+    """ The engine only changes how data are read, so ancestry assignments & adjusted PGS must be identical """
+    results = {}
+    for engine in ['pandas', 'polars']:
+        outdir = ancestry_args['outdir'] / engine
+        args = ancestry_args['args'] + ['--outdir', str(outdir), '--engine', engine]
+        if engine == 'polars':
+            args += ['--n_threads', '2']
+        with patch('sys.argv', args):
+            ancestry_analysis()
+        results[engine] = {x: pd.read_csv(outdir / f"target_{x}.txt.gz", sep='\t')
+                           for x in ['pgs', 'popsimilarity']}
+
+    for x in ['pgs', 'popsimilarity']:
+        assert not results['pandas'][x].empty
+        pd.testing.assert_frame_equal(results['pandas'][x], results['polars'][x])
+
+    # long format PGS output is sorted by sample, then PGS
+    pgs_index = results['pandas']['pgs'].set_index(['sampleset', 'IID', 'PGS']).index
+    assert pgs_index.is_monotonic_increasing
+
+
+@pytest.fixture
+def ancestry_args(tmp_path):
+    """ Small synthetic reference & target datasets. Aggregated scores are shuffled so row order differs from
+    the .pcs files (joins shouldn't reorder samples) """
+    rng = np.random.default_rng(42)
+
+    def write_pcs(prefix, n, path):
+        pcs = pd.DataFrame(rng.normal(size=(n, 12)), columns=[f'PC{i + 1}' for i in range(12)])
+        pcs.insert(0, 'IID', [f'{prefix}{i}' for i in range(n)])
+        pcs.to_csv(path, sep='\t', index=False)
+        return pcs['IID']
+
+    ref_ids = pd.concat([write_pcs('R', 60, tmp_path / 'ref_1.pcs'), write_pcs('S', 60, tmp_path / 'ref_2.pcs')])
+    target_ids = write_pcs('T', 30, tmp_path / 'target.pcs')
+
+    (pd.DataFrame({'#IID': ref_ids, 'SuperPop': rng.choice(['AFR', 'EAS', 'EUR'], len(ref_ids)), 'Sex': 1})
+     .to_csv(tmp_path / 'ref.psam', sep='\t', index=False))
+    with open(tmp_path / 'related.txt', 'w') as f:
+        f.write('\n'.join(ref_ids[:5]) + '\n')
+
+    scores = []
+    for sampleset, ids in [('reference', ref_ids), ('target', target_ids)]:
+        df = pd.DataFrame({'sampleset': sampleset, 'IID': ids.values})
+        for pgs in ['PGS000001', 'PGS000002_hmPOS_GRCh38']:
+            df[f'{pgs}_SUM'] = rng.normal(size=len(df))
+            df[f'{pgs}_AVG'] = rng.normal(size=len(df))
+        scores.append(df)
+    (pd.concat(scores).sample(frac=1, random_state=1)
+     .to_csv(tmp_path / 'aggregated_scores.txt.gz', sep='\t', index=False))
+
+    args = ['ancestry_analysis', '-d', 'target', '-r', 'reference',
+            '--ref_pcs', str(tmp_path / 'ref_1.pcs'), str(tmp_path / 'ref_2.pcs'),
+            '--target_pcs', str(tmp_path / 'target.pcs'), '--psam', str(tmp_path / 'ref.psam'),
+            '-x', str(tmp_path / 'related.txt'), '-s', str(tmp_path / 'aggregated_scores.txt.gz')]
+    return {'args': args, 'outdir': tmp_path}
@@ -0,0 +1,74 @@
+""" Test reading ancestry_analysis inputs (PCA projections, psam and aggregated scores) """
+
+import pandas as pd
+import pytest
+
+from pgscatalog_utils.ancestry.read import read_pgs, scan_pgs, read_pcs, extract_ref_psam_cols
+
+
+def test_read_pgs_suffix(aggregated_scores):
+    """ Only the literal _SUM suffix is removed (rstrip would also remove trailing S/U/M characters) """
+    df = read_pgs(aggregated_scores, onlySUM=True)
+    assert list(df.columns) == ['PGS_MUS', 'PGS000001']
+    assert list(df.index.names) == ['sampleset', 'IID']
+
+    lf = scan_pgs(aggregated_scores, onlySUM=True)
+    assert lf.columns == ['sampleset', 'IID', 'PGS_MUS', 'PGS000001']
+
+
+def test_read_pgs_all(aggregated_scores):
+    """ _AVG columns are kept and nothing is renamed if onlySUM is False """
+    df = read_pgs(aggregated_scores, onlySUM=False)
+    assert list(df.columns) == ['PGS_MUS_SUM', 'PGS_MUS_AVG', 'PGS000001_SUM', 'PGS000001_AVG']
+
+
+def test_read_ids_as_text(tmp_path):
+    """ Numeric & text IDs in different chunks must be read with the same type, or joins silently drop samples """
+    ids = [str(x) for x in range(5)] + ['NA12878']
+    (pd.DataFrame({'sampleset': 'test', 'IID': ids, 'PGS000001_SUM': 1.0})
+     .to_csv(tmp_path / 'aggregated_scores.txt.gz', sep='\t', index=False))
+    (pd.DataFrame({'IID': ids, 'PC1': 1.0})
+     .to_csv(tmp_path / 'test.pcs', sep='\t', index=False))
+
+    pgs = read_pgs(str(tmp_path / 'aggregated_scores.txt.gz'), onlySUM=True, chunksize=2)
+    assert {type(x) for x in pgs.index.get_level_values('IID')} == {str}
+
+    pcs = read_pcs([str(tmp_path / 'test.pcs')], dataset='test')
+    assert len(pcs.join(pgs, how='inner')) == len(ids)
+
+
+@pytest.mark.parametrize("id_cols", [['#IID'], ['#FID', 'IID']])
+def test_extract_psam(tmp_path, ref_pcs, id_cols):
+    """ psam files start with #IID, or #FID if family IDs are present (then IID is the second column) """
+    psam = pd.DataFrame({'SuperPop': ['EUR', 'AFR', 'EAS'], 'Population': ['GBR', 'YRI', 'CHB'], 'Sex': 1})
+    for x in reversed(id_cols):
+        psam.insert(0, x, ['A', 'B', 'C'])
+    psam.to_csv(tmp_path / 'ref.psam', sep='\t', index=False)
+
+    df = extract_ref_psam_cols(str(tmp_path / 'ref.psam'), 'reference', ref_pcs, keepcols=['SuperPop'])
+    assert list(df.columns) == ['PC1', 'SuperPop']
+    assert df['SuperPop'].to_list() == ['EUR', 'AFR']  # inner join: C isn't in ref_pcs
+
+
+def test_extract_psam_invalid(tmp_path, ref_pcs):
+    """ A psam without #IID or #FID as the first column is rejected """
+    pd.DataFrame({'IID': ['A', 'B'], 'SuperPop': ['EUR', 'AFR']}).to_csv(tmp_path / 'ref.psam', sep='\t', index=False)
+
+    with pytest.raises(ValueError, match="Invalid psam columns"):
+        extract_ref_psam_cols(str(tmp_path / 'ref.psam'), 'reference', ref_pcs, keepcols=['SuperPop'])
+
+
+@pytest.fixture
+def ref_pcs():
+    index = pd.MultiIndex.from_arrays([['reference', 'reference'], ['A', 'B']], names=['sampleset', 'IID'])
+    return pd.DataFrame({'PC1': [0.1, 0.2]}, index=index)
+
+
+@pytest.fixture
+def aggregated_scores(tmp_path):
+    path = tmp_path / 'aggregated_scores.txt.gz'
+    (pd.DataFrame({'sampleset': 'test', 'IID': ['A', 'B'],
+                   'PGS_MUS_SUM': [1.0, 2.0], 'PGS_MUS_AVG': [0.1, 0.2],
+                   'PGS000001_SUM': [3.0, 4.0], 'PGS000001_AVG': [0.3, 0.4]})
+     .to_csv(path, sep='\t', index=False))
+    return str(path)